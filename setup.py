@@ -6,8 +6,11 @@ from setuptools import find_packages, setup
 long_description = """FastAPI service to process QA requests."""
 
 requirements_list = [
+    "cachetools",
     "fastapi==0.72.0",
-    "uvicorn"
+    "orjson",
+    "uvicorn",
+    "uvloop; sys_platform != 'win32'",
 ]
 
 
@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import FastAPI
 
 from codingchallenge_qa_service._version import __version__
@@ -33,5 +35,14 @@ def create_app() -> FastAPI:
     logger.info("registering middlewares")
     app.add_middleware(TransactionMiddleware)
 
+    """
+    Add Event Handlers
+    """
+    @app.on_event("startup")
+    async def log_event_loop():
+        # uvicorn picks uvloop when it is installed, log it so a fallback to the default loop is visible
+        loop = type(asyncio.get_running_loop())
+        logger.info(f"[APP] event loop: {loop.__module__}.{loop.__qualname__}")
+
     logger.info("[APP] ready for liftoff 🚀")
     return app
@@ -3,22 +3,24 @@ from datetime import datetime, timezone
 
 
 class Clock:
+    __slots__ = ("start_time", "stop_time")
+
     def __init__(self):
-        self.start_time: float = None
-        self.stop_time: float = None
+        self.start_time: int = None
+        self.stop_time: int = None
 
     def start(self):
-        self.reset()
-        self.start_time = time.time()
+        self.stop_time = None
+        self.start_time = time.perf_counter_ns()
 
     def stop(self) -> float:
-        self.stop_time = time.time()
+        self.stop_time = time.perf_counter_ns()
         return self.get_elapsed_time()
 
     def get_elapsed_time(self) -> float:
         if self.start_time is None or self.stop_time is None:
             return None
-        return self.stop_time - self.start_time
+        return (self.stop_time - self.start_time) / 1e9
 
     def reset(self):
         self.start_time = None
@@ -2,6 +2,7 @@ from codingchallenge_qa_service.logging import getLogger
 from typing import Awaitable, Callable
 
 from fastapi import Request, Response
+from starlette.background import BackgroundTask
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from codingchallenge_qa_service._version import __version__
@@ -37,11 +38,24 @@ class TransactionMiddleware(BaseHTTPMiddleware):
                     "codingchallenge_qa_service_release_version": __version__,
                 }
             )
+
+        # storing the transaction is not needed for the answer, so it runs once the response has been sent
+        response.background = BackgroundTask(self._persist_transaction, request)
+        return response
+
+    @staticmethod
+    async def _persist_transaction(request: Request):
+        if request.state.transaction.should_store:
             try:
                 request.app.state.services.transaction_service.create(request.state.transaction)
                 logger.info(
                     "[Transaction_Middleware] Transaction created: " f"'{request.state.transaction.transaction_id}'",
-                    extra={"context": request.state.transaction.transaction_data},
+                    extra={
+                        "context": {
+                            **request.state.transaction.transaction_data,
+                            "pipeline_steps": request.state.transaction.pipeline_steps.to_dict(),
+                        }
+                    },
                 )
             except Exception as e:
                 logger.error(
@@ -59,5 +73,3 @@ class TransactionMiddleware(BaseHTTPMiddleware):
                     "[Transaction_Middleware] exception thrown in update transaction",
                     exc_info=e,
                 )
-
-        return response
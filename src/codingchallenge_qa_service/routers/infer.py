@@ -1,10 +1,16 @@
 import asyncio
+import functools
+import logging
+import re
+from hashlib import blake2b
 from enum import Enum
 from codingchallenge_qa_service.logging import getLogger
-from typing import Any, Dict, Optional, Union
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 from uuid import uuid4
 
+from cachetools import TTLCache
 from fastapi import APIRouter, BackgroundTasks, Request, Response, HTTPException
+from fastapi.responses import ORJSONResponse
 
 from codingchallenge_qa_service.models.paraphrase_models import ParaphraseServiceRequest, ParaphraseServiceResponse
 from codingchallenge_qa_service.models.qa_models import Language
@@ -15,7 +21,33 @@ from codingchallenge_qa_service.measure import Clock, Measure
 logger = getLogger(name=__name__)
 
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
+
+_WHITESPACE = re.compile(r"\s+")
+
+_UNKNOWN = {
+    Language.EN: frozenset({"unknown", "unknown."}),
+    Language.DE: frozenset({"unbekannt", "unbekannt."}),
+}
+_VALIDITY_CHECK: Dict[Language, Callable[[str], bool]] = {
+    language: (lambda answer, unknown=unknown: answer.casefold() not in unknown)
+    for language, unknown in _UNKNOWN.items()
+}
+
+# misses expire sooner than hits, so newly added gold standard answers show up quickly
+_paraphrase_cache: TTLCache = TTLCache(maxsize=10_000, ttl=600)
+_paraphrase_miss_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+# model answers below this confidence are treated like an empty answer. There is no calibration data for the
+# QA model yet, 0.5 only drops answers the model itself rates as more likely wrong than right.
+_MIN_ANSWER_CONFIDENCE = 0.5
+
+# keyed by a digest of the text, so no raw (possibly sensitive) content is kept in memory
+_scd_cache: TTLCache = TTLCache(maxsize=50_000, ttl=3600)
+
+# concurrent identical inference requests share one call, finished results are reused for a short while
+_inference_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_inflight_inference: Dict[Tuple, asyncio.Task] = {}
 
 
 class ResponseType(str, Enum):
@@ -28,26 +60,20 @@ class ResponseType(str, Enum):
 
 
 def _check_answer_validity(answer: str, language: Language) -> bool:
-    unknown_response = ["unknown", "unknown."] if language == Language.EN else ["unbekannt", "unbekannt."]
-    if answer is None or answer == "":
-        return False
-    elif answer.lower() in unknown_response:
-        return False
-    return True
-
+    return bool(answer) and _VALIDITY_CHECK[language](answer)
 
-def _clean_question(question: str) -> str:
-    # preprocess query (remove extra whitespaces)
-    cleaned_question = question.strip()
-    return cleaned_question
 
+def _normalize_question(question: str) -> str:
+    # cache key only, the paraphrase service still receives the cleaned question
+    return _WHITESPACE.sub(" ", question).casefold()
 
-def _clean_answer(answer: str) -> str:
-    cleaned_answer = answer.strip()
-    return cleaned_answer
 
+async def _run_sensitive_content_detection(request, query: str, user_id: str) -> Tuple[Dict[str, str], bool]:
+    key = blake2b(query.encode(), digest_size=16).digest()
+    cached = _scd_cache.get(key)
+    if cached is not None:
+        return cached, True
 
-async def _run_sensitive_content_detection(request, query: str, user_id: str) -> Dict[str, str]:
     try:
         scd_response = await request.app.state.services.sensitive_content_detection_service.run(
             query=query, user_id=user_id
@@ -56,24 +82,20 @@ async def _run_sensitive_content_detection(request, query: str, user_id: str) ->
         request.state.transaction.record({"error": "Exception in Sensitive Content Detection.", "exc_info": e})
         logger.error("Exception in Sensitive Content Detection: ", exc_info=e)
         raise HTTPException(status_code=500, detail="Sensitive Content Detection Exception.")
-    return scd_response
+    _scd_cache[key] = scd_response
+    return scd_response, False
 
 
 async def _question_has_sensitive_content(request: Request, user_id: str, question: str) -> bool:
     time_sensitive_content_detection: Clock = Measure.start_clock()
-    scd_response = await _run_sensitive_content_detection(request, question, user_id)
-    request.state.transaction.record(
-        {
-            "pipeline_steps": {
-                "sensitive_content_detection_question": {
-                    "sensitivity": scd_response["sensitivity"],
-                    "model_name": scd_response["model_name"],
-                    "duration": time_sensitive_content_detection.stop(),
-                }
-            },
-            "question_sensitivity": scd_response["sensitivity"],
-        }
-    )
+    scd_response, cache_hit = await _run_sensitive_content_detection(request, question, user_id)
+    request.state.transaction.pipeline_steps.sensitive_content_detection_question = {
+        "sensitivity": scd_response["sensitivity"],
+        "model_name": scd_response["model_name"],
+        "duration": time_sensitive_content_detection.stop(),
+        "cache_hit": cache_hit,
+    }
+    request.state.transaction.record({"question_sensitivity": scd_response["sensitivity"]})
 
     logger.info(
         f"Classified question as {scd_response['sensitivity']}.",
@@ -84,19 +106,14 @@ async def _question_has_sensitive_content(request: Request, user_id: str, questi
 
 async def _answer_has_sensitive_content(request: Request, user_id: str, answer: str) -> bool:
     time_sensitive_content_detection: Clock = Measure.start_clock()
-    scd_response = await _run_sensitive_content_detection(request, answer, user_id)
-    request.state.transaction.record(
-        {
-            "pipeline_steps": {
-                "sensitive_content_detection_answer": {
-                    "sensitivity": scd_response["sensitivity"],
-                    "model_name": scd_response["model_name"],
-                    "duration": time_sensitive_content_detection.stop(),
-                }
-            },
-            "answer_sensitivity": scd_response["sensitivity"],
-        }
-    )
+    scd_response, cache_hit = await _run_sensitive_content_detection(request, answer, user_id)
+    request.state.transaction.pipeline_steps.sensitive_content_detection_answer = {
+        "sensitivity": scd_response["sensitivity"],
+        "model_name": scd_response["model_name"],
+        "duration": time_sensitive_content_detection.stop(),
+        "cache_hit": cache_hit,
+    }
+    request.state.transaction.record({"answer_sensitivity": scd_response["sensitivity"]})
     logger.info(
         f"Classified answer as {scd_response['sensitivity']}.",
         extra={"context": {"answer": answer, "sensitivity": scd_response["sensitivity"]}},
@@ -104,9 +121,9 @@ async def _answer_has_sensitive_content(request: Request, user_id: str, answer:
     return scd_response["sensitivity"] != "SAFE"
 
 
-async def _get_prefiltered_documents_from_elasticsearch(
+async def _run_prefiltering(
     request: Request, course_id: str, question: str, language: Language
-) -> Dict:
+) -> Tuple[Dict, float]:
     time_preselection: Clock = Measure.start_clock()
     try:
         prefiltered_doc = await request.app.state.services.prefiltering_service.run(
@@ -114,84 +131,131 @@ async def _get_prefiltered_documents_from_elasticsearch(
             language=language,
             coursebook_ids=[course_id],
         )
+    except asyncio.CancelledError:
+        # prefiltering is started speculatively, keep track of how often its result is not needed
+        request.state.transaction.pipeline_steps.preselection = {
+            "speculative_es_wasted": True,
+            "duration": time_preselection.stop(),
+        }
+        raise
+    return prefiltered_doc, time_preselection.stop()
+
+
+async def _get_prefiltered_documents_from_elasticsearch(request: Request, prefilter_task: asyncio.Task) -> Dict:
+    # prefiltering runs speculatively, its outcome is only recorded once the result is actually used
+    try:
+        prefiltered_doc, duration = await prefilter_task
     except Exception as e:
         request.state.transaction.record({"error": "Exception in Prefiltering.", "exc_info": e})
         logger.error("Exception in Prefiltering: ", exc_info=e)
         raise HTTPException(
             status_code=412, detail="Failed to fetch prefiltered document from ElasticSearch."
         )
-    request.state.transaction.record(
-        {
-            "pipeline_steps": {
-                "preselection": {
-                    "result": {"doc_id": prefiltered_doc["doc_id"]} if prefiltered_doc else {},
-                    "duration": time_preselection.stop(),
-                }
-            },
-        }
-    )
+    request.state.transaction.pipeline_steps.preselection = {
+        "result": {"doc_id": prefiltered_doc["doc_id"]} if prefiltered_doc else {},
+        "duration": duration,
+    }
     if not prefiltered_doc:
         logger.info("No relevant data found while prefiltering.")
 
     return prefiltered_doc
 
 
+async def _paraphrase_cached(
+    request: Request, course_id: str, cleaned_question: str
+) -> Tuple[Optional[ParaphraseServiceResponse], bool]:
+    key = (course_id, _normalize_question(cleaned_question))
+    cached = _paraphrase_cache.get(key)
+    if cached is not None:
+        return cached, True
+    if _paraphrase_miss_cache.get(key):
+        return None, True
+
+    answer_from_paraphrase = await request.app.state.services.paraphrase_service.find_paraphrase(
+        ParaphraseServiceRequest(
+            question_content_str=cleaned_question,
+            course_id=course_id,
+        )
+    )
+    if answer_from_paraphrase:
+        _paraphrase_cache[key] = answer_from_paraphrase
+    else:
+        _paraphrase_miss_cache[key] = True
+    return answer_from_paraphrase, False
+
+
 async def _get_answer_from_paraphrase(
     request: Request, course_id: str, cleaned_question: str
 ) -> Optional[ParaphraseServiceResponse]:
     time_paraphrase: Clock = Measure.start_clock()
     answer_from_paraphrase = None
+    cache_hit = False
     try:
-        answer_from_paraphrase = await request.app.state.services.paraphrase_service.find_paraphrase(
-            ParaphraseServiceRequest(
-                question_content_str=cleaned_question,
-                course_id=course_id,
-            )
-        )
+        answer_from_paraphrase, cache_hit = await _paraphrase_cached(request, course_id, cleaned_question)
     except Exception as e:
         logger.error("Failed to connect to the paraphrase service.", exc_info=e)
         request.state.transaction.record({"error": "Exception in Paraphrasing.", "exc_info": e})
     if answer_from_paraphrase:
         logger.info("Gold Standard answer retrieved from Paraphrase service.")
-        request.state.transaction.record(
-            {
-                "pipeline_steps": {
-                    "paraphrase": {
-                        "result": answer_from_paraphrase,
-                        "duration": time_paraphrase.stop(),
-                    }
-                },
-            }
-        )
+        request.state.transaction.pipeline_steps.paraphrase = {
+            "result": answer_from_paraphrase,
+            "duration": time_paraphrase.stop(),
+            "cache_hit": cache_hit,
+        }
     return answer_from_paraphrase
 
 
+def _finish_inference(key: Tuple, task: asyncio.Task) -> None:
+    _inflight_inference.pop(key, None)
+    if not task.cancelled() and task.exception() is None:
+        _inference_cache[key] = task.result()
+
+
+async def _inference_coalesced(
+    request: Request, user_id: str, course_id: str, question: str, doc: Dict, language: str
+) -> Tuple[Dict[str, Any], bool]:
+    key = (course_id, question, doc.get("doc_id"), language)
+    cached = _inference_cache.get(key)
+    if cached is not None:
+        return cached, True
+
+    task = _inflight_inference.get(key)
+    if task is None:
+        task = asyncio.create_task(
+            request.app.state.services.infer_service.run(query=question, doc=doc, user_id=user_id, language=language)
+        )
+        _inflight_inference[key] = task
+        task.add_done_callback(functools.partial(_finish_inference, key))
+    # shielded, so a cancelled request does not cancel the call other requests are waiting for
+    return await asyncio.shield(task), False
+
+
 async def _get_model_inference_result(
-    request: Request, user_id: str, question: str, doc: Dict, language: str
+    request: Request, user_id: str, course_id: str, question: str, doc: Dict, language: str
 ) -> Dict[str, Any]:
     try:
         time_qa: Clock = Measure.start_clock()
-        inference_response = await request.app.state.services.infer_service.run(
-            query=question, doc=doc, user_id=user_id, language=language
+        inference_response, cache_hit = await _inference_coalesced(
+            request, user_id, course_id, question, doc, language
         )
         model_name = inference_response["model_context"]["model_name"]
-        request.state.transaction.record(
-            {
-                "model_name": model_name,
-                "answer": inference_response["answer"],
-                "pipeline_steps": {
-                    "inference": {
-                        "model_name": model_name,
-                        "inference_body": inference_response,
-                        "duration": time_qa.stop(),
-                    }
-                },
-            }
-        )
+        request.state.transaction.pipeline_steps.inference = {
+            "model_name": model_name,
+            "inference_body": inference_response,
+            "duration": time_qa.stop(),
+            "cache_hit": cache_hit,
+        }
+        request.state.transaction.record({"model_name": model_name, "answer": inference_response["answer"]})
         logger.info(
             "QA Service result ",
             extra={"context": {"model_name": model_name, "answer": inference_response["answer"]}},
         )
+
+        # answers without a numeric confidence are trusted
+        confidence = inference_response["model_context"].get("confidence")
+        if isinstance(confidence, (int, float)) and confidence < _MIN_ANSWER_CONFIDENCE:
+            logger.info("Discarding low confidence QA Service result.", extra={"context": {"confidence": confidence}})
+            return {**inference_response, "answer": ""}
     except Exception as e:
         request.state.transaction.record({"error": "Exception in QAService.", "exc_info": e})
         logger.error("Exception in QAService: ", exc_info=e)
@@ -200,15 +264,31 @@ async def _get_model_inference_result(
     return inference_response
 
 
+def _retrieve_task_outcome(task: asyncio.Task) -> None:
+    # failures of discarded tasks are not needed, retrieving them avoids "exception was never retrieved" warnings
+    if not task.cancelled():
+        task.exception()
+
+
+async def _discard_tasks(*tasks: asyncio.Task) -> None:
+    for task in tasks:
+        task.cancel()
+        task.add_done_callback(_retrieve_task_outcome)
+    # asyncio.wait neither raises the tasks' errors nor swallows a cancellation of the caller
+    await asyncio.wait(tasks)
+
+
 @router.post("/infer")
 async def infer(
     request: Request, request_body: InferRequest, background_tasks: BackgroundTasks
 ) -> Union[InferResponse, Response]:
-    logger.debug("request received", extra={"request_body": request_body.dict()})
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("request received", extra={"request_body": request_body.dict()})
     request.state.transaction.should_store = True
 
     question_uuid = uuid4()
-    cleaned_question = _clean_question(request_body.query)
+    # preprocess query (remove extra whitespaces)
+    cleaned_question = request_body.query.strip()
     request.state.transaction.record(
         {
             "request_body": request_body,
@@ -222,39 +302,56 @@ async def infer(
         }
     )
 
-    has_sensitive_content, paraphrase = await asyncio.gather(
-        _question_has_sensitive_content(request, request_body.user.id, cleaned_question),
-        _get_answer_from_paraphrase(request, request_body.course_id, cleaned_question),
+    # prefiltering has no data dependency on the question checks, so all three run concurrently.
+    # It is only needed if no paraphrase is found and gets cancelled otherwise.
+    scd_task = asyncio.create_task(
+        _question_has_sensitive_content(request, request_body.user.id, cleaned_question)
     )
-
-    if has_sensitive_content:
-        return Response(status_code=400)
-
-    if paraphrase:
-        return InferResponse(
-            answer=paraphrase.gs_answer_content_str,
-            question=cleaned_question,
-            answer_validity="valid",
-            transaction_id=request.state.transaction.transaction_id,
-            is_gs_answer=True,
-            question_uuid=question_uuid,
+    paraphrase_task = asyncio.create_task(
+        _get_answer_from_paraphrase(request, request_body.course_id, cleaned_question)
+    )
+    prefilter_task = asyncio.create_task(
+        _run_prefiltering(
+            request,
+            request_body.course_id,
+            cleaned_question,
+            request_body.language,
         )
-
-    prefiltered_doc = await _get_prefiltered_documents_from_elasticsearch(
-        request,
-        request_body.course_id,
-        cleaned_question,
-        request_body.language,
     )
+    try:
+        # the verdict alone decides a rejection, so it is awaited first and a sensitive question returns
+        # without waiting for the paraphrase lookup, which is cancelled in the finally block
+        if await scd_task:
+            return Response(status_code=400)
+
+        paraphrase = await paraphrase_task
+        if paraphrase:
+            return InferResponse(
+                answer=paraphrase.gs_answer_content_str,
+                question=cleaned_question,
+                answer_validity="valid",
+                transaction_id=request.state.transaction.transaction_id,
+                is_gs_answer=True,
+                question_uuid=question_uuid,
+            )
+
+        prefiltered_doc = await _get_prefiltered_documents_from_elasticsearch(request, prefilter_task)
+    finally:
+        await _discard_tasks(scd_task, paraphrase_task, prefilter_task)
 
     if not prefiltered_doc:
         return Response(status_code=404)
 
     model_inference_result = await _get_model_inference_result(
-        request, request_body.user.id, cleaned_question, prefiltered_doc, request_body.language
+        request,
+        request_body.user.id,
+        request_body.course_id,
+        cleaned_question,
+        prefiltered_doc,
+        request_body.language,
     )
 
-    cleaned_answer = _clean_answer(model_inference_result["answer"])
+    cleaned_answer = model_inference_result["answer"].strip()
 
     if not _check_answer_validity(cleaned_answer, request_body.language):
         return Response(status_code=404)
@@ -1,13 +1,32 @@
-import json
 from codingchallenge_qa_service.logging import getLogger
-from typing import Any, Dict
+from dataclasses import dataclass, fields
+from typing import Any, Dict, Optional
 from uuid import uuid4
 
+import orjson
 from fastapi.encoders import jsonable_encoder
 
 logger = getLogger(name=__name__)
 
 
+@dataclass
+class PipelineSteps:
+    """Results of the single pipeline steps, assigned directly by the steps and serialized once in to_dict"""
+
+    sensitive_content_detection_question: Optional[Dict] = None
+    paraphrase: Optional[Dict] = None
+    preselection: Optional[Dict] = None
+    inference: Optional[Dict] = None
+    sensitive_content_detection_answer: Optional[Dict] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            field.name: getattr(self, field.name)
+            for field in fields(self)
+            if getattr(self, field.name) is not None
+        }
+
+
 class Transaction:
     MAPPING = {
         "mappings": {
@@ -61,6 +80,7 @@ class Transaction:
     def __init__(self):
         self.transaction_id: str = str(uuid4())
         self.transaction_data = {}
+        self.pipeline_steps = PipelineSteps()
         self.should_store = False
         self.should_update = False
 
@@ -111,6 +131,12 @@ class Transaction:
                 and self.MAPPING["mappings"]["properties"][key]["type"] == "text"
             ):
                 logger.info(f"changing type of {key}")
-                transaction_dict[key] = json.dumps(transaction_dict[key])
+                transaction_dict[key] = orjson.dumps(transaction_dict[key], option=orjson.OPT_NON_STR_KEYS).decode()
+
+        pipeline_steps = self.pipeline_steps.to_dict()
+        if pipeline_steps:
+            transaction_dict["pipeline_steps"] = orjson.dumps(
+                jsonable_encoder(pipeline_steps), option=orjson.OPT_NON_STR_KEYS
+            ).decode()
 
         return transaction_dict